@@ -1,7 +1,6 @@
 import math
 import csv
 import os, sys
-import unittest
 
 
 loci = ["AMEL", "D3S1358", "D1S1656", "D2S441", "D10S1248",
@@ -19,6 +18,25 @@ channel_dictionary = {
         "TPOX": "Yellow", "DYS391": "Yellow", "D8S1179": "Red",
         "D12S391": "Red", "D19S433": "Red", "FGA": "Red", "D22S1045": "Red"}
 
+# Default thresholds for the QC stage. Heights are in RFU and the overlap
+# window is in base pairs.
+saturation_threshold = 30000
+dropout_threshold = 100
+overlap_window = 0.5
+# Size differences are compared to the overlap window with this much slack so
+# both QC engines give the same answer at the edge of the window.
+overlap_tolerance = 1e-6
+
+
+def output_file_name(fileName, outputDirectory=None, suffix="_newoutput"):
+    """Returns the output file name for a report: the input name without its
+    extension plus suffix and ".tsv", next to the input file or in
+    outputDirectory when it is given."""
+    outputFileName = os.path.splitext(fileName)[0]
+    if outputDirectory is not None:
+        outputFileName = os.path.join(outputDirectory, os.path.basename(outputFileName))
+    return outputFileName + suffix + ".tsv"
+
 
 class AlleleUnit:
 
@@ -282,6 +300,7 @@ class ReportDB:
         self.samplePropertiesDict = self.make_properties_dict()
 
         self.samplePullupDict = self.make_pullup_dict()
+        self.qcColumns = QCColumns()
 
     def profile_codes(self):
         """Takes a list of profiles as lines from the input and splits them
@@ -340,9 +359,9 @@ class ReportDB:
 
         It skips the Amelogenin and DYS391 loci.
 
-        It checks for the following issues: overlapping, dropout,
-        saturation, and ILS failure. While determining if there is dropout it
-        sets the flags if dropout is found."""
+        It checks for ILS failure. Overlapping, dropout and saturation are
+        checked afterwards by mark_qc using the profile stored here for
+        each sample."""
         for sampleSet in self.samplesSorted:
             sampleName = sampleSet[1][1]
             NOC = 1
@@ -364,9 +383,12 @@ class ReportDB:
             else:
                 sampleForData = sampleSet[1][1].split("_")[1]
             profileForData = profilesDB.getProfile(sampleForData)
+            self.samplePropertiesDict[sampleName].profile = profileForData
             for peak in sampleSet:
 
                 peak.append(str(NOC))
+                parentIndex = -1
+                pullupIndex = -1
                 if peak[self.Marker] != '' and sampleForData not in ["Ladder", "Amp Neg"] \
                     and peak[self.Sample_Comments] not in \
                         ["ILS Failure", "ILS Fails", "Misplating Fails", "Size Call Failed"]:
@@ -374,16 +396,21 @@ class ReportDB:
 
                     if currentAllele in profileForData.profile[peak[self.Marker]]:
                         peak.append("Par")
+                        pullupSizes = None
                         if peak[self.Dye] == "Blue":
-                            self.samplePullupDict[sampleName].Blue.append(peak[self.Size])
+                            pullupSizes = self.samplePullupDict[sampleName].Blue
                         elif peak[self.Dye] == "Green":
-                            self.samplePullupDict[sampleName].Green.append(peak[self.Size])
+                            pullupSizes = self.samplePullupDict[sampleName].Green
                         elif peak[self.Dye] == "Yellow":
-                            self.samplePullupDict[sampleName].Yellow.append(peak[self.Size])
+                            pullupSizes = self.samplePullupDict[sampleName].Yellow
                         elif peak[self.Dye] == "Red":
-                            self.samplePullupDict[sampleName].Red.append(peak[self.Size])
+                            pullupSizes = self.samplePullupDict[sampleName].Red
+                        if pullupSizes is not None:
+                            pullupIndex = len(pullupSizes)
+                            pullupSizes.append(peak[self.Size])
 
                         currentPropDict = self.samplePropertiesDict[sampleName].loci[peak[self.Marker]]
+                        parentIndex = len(currentPropDict.Peak_BP)
                         #self.samplePropertiesDict[sampleName].loci[peak[self.Marker]].Peak_BP.append(peak[self.Size])
                         currentPropDict.Peak_BP.append(peak[self.Size])
                         #self.samplePropertiesDict[sampleName].loci[peak[self.Marker]].Peak_Profiles.append(peak[self.Allele])
@@ -399,6 +426,197 @@ class ReportDB:
                 else:
                     peak.append("X")
 
+                if profileForData is not None and self.is_loci_of_interest(peak[self.Marker]) \
+                        and peak[self.Program_Output] != "Fail":
+                    self.qcColumns.add(peak, sampleName, peak[self.Marker], peak[self.Dye],
+                                       peak[self.Height], peak[self.Size], parentIndex, pullupIndex)
+
+
+    def mark_qc(self, saturation=saturation_threshold, dropout=dropout_threshold,
+                overlap=overlap_window, engine="python"):
+        """Flags saturated parent peaks, dropped out profile alleles and
+        overlapping peaks. This runs after mark_parent_peaks and before
+        mark_stutter and mark_pullup.
+
+        The Height and Size columns are collected by mark_parent_peaks as it
+        goes through the report, and the checks are done over those columns
+        grouped by sample and locus, or by sample and dye for overlap. The
+        engine is either "python" or "numpy"; numpy is only imported when it
+        is selected.
+
+        Parent peaks at or above the saturation threshold get ",sat" and set
+        the Saturation flag of their locus. Parent peaks below the dropout
+        threshold are relabeled del followed by their place in the profile,
+        del1 or del2 for a single source and up to the number of alleles in
+        a mixture, and are also left out of the pullup check. Both kinds of
+        parent are left out of the stutter calls, the other parent at the
+        locus is still used. Drop_Out is set for any locus with fewer usable
+        parent peaks than profile alleles. Peaks within the overlap window
+        of a peak from another marker in the same dye are marked overlap."""
+        if dropout > saturation:
+            raise ValueError("The dropout threshold must not be above the saturation threshold")
+        if engine == "numpy":
+            qc_engine = self.qc_numpy
+        elif engine == "python":
+            qc_engine = self.qc_python
+        else:
+            raise ValueError("Unknown QC engine: " + str(engine))
+
+        columns = self.qcColumns
+        markerIndex = {}
+        locusMarkers = [markerIndex.setdefault(locus, len(markerIndex))
+                        for sampleName, locus in columns.locusIndex]
+        saturated, low, overlapping, parentCounts = qc_engine(
+            columns.heights, columns.sizes, columns.parentIndex, columns.locusIds,
+            columns.dyeIds, locusMarkers, saturation, dropout, overlap)
+
+        removedParents = {}
+        removedPullup = {}
+        for x in saturated:
+            peak = columns.rows[x]
+            self.samplePropertiesDict[peak[1]].loci[peak[self.Marker]].Saturation = True
+            removedParents.setdefault((peak[1], peak[self.Marker]), set()).add(columns.parentIndex[x])
+            peak[self.Program_Output] = peak[self.Program_Output] + ",sat"
+
+        for x in low:
+            peak = columns.rows[x]
+            profileAlleles = self.samplePropertiesDict[peak[1]].profile.profile[peak[self.Marker]]
+            parentNumber = profileAlleles.index(AlleleUnit(peak[self.Allele])) + 1
+            removedParents.setdefault((peak[1], peak[self.Marker]), set()).add(columns.parentIndex[x])
+            if columns.pullupIndex[x] >= 0:
+                removedPullup.setdefault((peak[1], peak[self.Dye]), set()).add(columns.pullupIndex[x])
+            peak[self.Program_Output] = "del" + str(parentNumber)
+
+        self.remove_parents(removedParents, removedPullup)
+
+        for x in overlapping:
+            peak = columns.rows[x]
+            if peak[self.Program_Output] == "X":
+                peak[self.Program_Output] = "overlap"
+            else:
+                peak[self.Program_Output] = peak[self.Program_Output] + ",overlap"
+
+        # Samples without any usable rows, such as ILS failures, are not
+        # marked as drop out.
+        activeSamples = {sampleName for sampleName, locus in columns.locusIndex}
+        for sampleName in activeSamples:
+            sampleProperties = self.samplePropertiesDict[sampleName]
+            for locus, locusProperties in sampleProperties.loci.items():
+                if not self.is_loci_of_interest(locus):
+                    continue
+                expected = len([allele for allele in sampleProperties.profile.profile[locus]
+                                if allele.locusType == "Number"])
+                locusId = columns.locusIndex.get((sampleName, locus))
+                found = parentCounts[locusId] if locusId is not None else 0
+                if found < expected:
+                    locusProperties.Drop_Out = True
+
+    def remove_parents(self, removedParents, removedPullup):
+        """Takes flagged parent peaks out of the stutter parents of their
+        locus and out of the pullup sizes of their sample. Both arguments map
+        a (sample, locus) or (sample, dye) key to the list positions that
+        mark_parent_peaks recorded for those peaks."""
+        for (sampleName, locus), positions in removedParents.items():
+            locusProperties = self.samplePropertiesDict[sampleName].loci[locus]
+            locusProperties.Peak_BP = [size for x, size in enumerate(locusProperties.Peak_BP)
+                                       if x not in positions]
+            locusProperties.Peak_Profiles = [allele for x, allele in enumerate(locusProperties.Peak_Profiles)
+                                             if x not in positions]
+        for (sampleName, dye), positions in removedPullup.items():
+            samplePullup = self.samplePullupDict[sampleName]
+            setattr(samplePullup, dye, [size for x, size in enumerate(getattr(samplePullup, dye))
+                                        if x not in positions])
+
+    def qc_python(self, heights, sizes, parentIndex, locusIds, dyeIds, locusMarkers,
+                  saturation, dropout, overlap):
+        """Pure Python version of the QC checks. Heights and sizes are the
+        strings from the report, a peak is a parent when its parentIndex is
+        not -1 and locusMarkers numbers the marker of each locus group.
+        Returns the row numbers of saturated, low and overlapping peaks and
+        the count of usable parent peaks for each locus group."""
+        saturated, low = [], []
+        parentCounts = [0] * len(locusMarkers)
+        for x, index in enumerate(parentIndex):
+            if index < 0:
+                continue
+            height = float(heights[x] or 0)
+            if height < dropout:
+                low.append(x)
+                continue
+            if height >= saturation:
+                saturated.append(x)
+            parentCounts[locusIds[x]] += 1
+
+        markerIds = [locusMarkers[locusId] for locusId in locusIds]
+        sizes = [float(size or 0) for size in sizes]
+
+        # Every peak is compared with all the peaks after it in the same dye
+        # that are still inside the overlap window.
+        window = overlap + overlap_tolerance
+        keys = sorted(zip(dyeIds, sizes, range(len(sizes))))
+        overlapping = set()
+        for position, (dye, size, first) in enumerate(keys):
+            later = position + 1
+            while later < len(keys) and keys[later][0] == dye \
+                    and keys[later][1] - size <= window:
+                second = keys[later][2]
+                if markerIds[first] != markerIds[second]:
+                    overlapping.update((first, second))
+                later += 1
+
+        return saturated, low, sorted(overlapping), parentCounts
+
+    def qc_numpy(self, heights, sizes, parentIndex, locusIds, dyeIds, locusMarkers,
+                 saturation, dropout, overlap):
+        """NumPy version of qc_python with the same inputs and outputs."""
+        import numpy as np
+
+        def to_float(values):
+            try:
+                return np.array(values, dtype=float)
+            except ValueError:
+                return np.array([float(value or 0) for value in values])
+
+        height = to_float(heights)
+        size = to_float(sizes)
+        parent = np.asarray(parentIndex, dtype=np.intp) >= 0
+        locus = np.asarray(locusIds, dtype=np.intp)
+        dye = np.asarray(dyeIds, dtype=np.intp)
+        marker = np.asarray(locusMarkers, dtype=np.intp)[locus]
+
+        low = parent & (height < dropout)
+        saturated = parent & ~low & (height >= saturation)
+        parentCounts = np.bincount(locus[parent & ~low], minlength=len(locusMarkers))
+
+        # The peaks are sorted by dye and size, then each peak is compared
+        # with the peak k places after it for k = 1, 2, ... until no peak is
+        # left with a later peak inside its window.
+        window = overlap + overlap_tolerance
+        order = np.lexsort((size, dye))
+        sortedSize = size[order]
+        sortedDye = dye[order]
+        sortedMarker = marker[order]
+        first = np.arange(len(order) - 1) if len(order) else np.zeros(0, dtype=np.intp)
+        firsts = []
+        seconds = []
+        k = 1
+        while first.size:
+            second = first + k
+            inWindow = (sortedDye[second] == sortedDye[first]) \
+                & (sortedSize[second] - sortedSize[first] <= window)
+            first = first[inWindow]
+            second = second[inWindow]
+            pairs = sortedMarker[first] != sortedMarker[second]
+            firsts.append(first[pairs])
+            seconds.append(second[pairs])
+            k += 1
+            first = first[first + k < len(order)]
+        overlapping = np.zeros(0, dtype=np.intp)
+        if firsts:
+            overlapping = np.union1d(order[np.concatenate(firsts)], order[np.concatenate(seconds)])
+
+        return np.flatnonzero(saturated).tolist(), np.flatnonzero(low).tolist(), \
+            overlapping.tolist(), parentCounts.tolist()
 
     # Rework the following three functions to work with the current structure of the program
     def in_stutter_position(self, parent, position, allele):
@@ -440,6 +658,7 @@ class ReportDB:
         These loci are separated from the tetramer loci.
 
         This function checks flags to determine if the allele can be used.
+        Parents that mark_qc found saturated or dropped out are not used.
         """
 
         for sampleSet in self.samplesSorted:
@@ -461,8 +680,9 @@ class ReportDB:
             for peak in sampleSet:
                 #peak[self.NOC] = NOC
                 if self.is_loci_of_interest(peak[self.Marker]):
-                    alleles = self.samplePropertiesDict[sampleSet[1][1]].loci[peak[self.Marker]].Peak_Profiles
-                    peakSizes = self.samplePropertiesDict[sampleSet[1][1]].loci[peak[self.Marker]].Peak_BP
+                    currentLocus = self.samplePropertiesDict[sampleSet[1][1]].loci[peak[self.Marker]]
+                    alleles = currentLocus.Peak_Profiles
+                    peakSizes = currentLocus.Peak_BP
                     for x in range(len(alleles)):
                         repeatMultiple = 0
                         if peak[self.Marker] not in ["D22S1045", "Penta D", "Penta E"]:
@@ -548,14 +768,17 @@ class ReportDB:
                                 peak[self.Program_Output] = peak[self.Program_Output] + ",pullup"
 
 
-    def write_output(self):
-        outputFileName = self.fileName.rsplit('.', 1)[0]
+    def write_output(self, outputDirectory=None, suffix="_newoutput"):
+        """Writes the marked report to the file named by output_file_name
+        and returns that file name."""
+        outputFileName = output_file_name(self.fileName, outputDirectory, suffix)
 
-        outputFile = open(outputFileName + "_newoutput.tsv", "w")
+        outputFile = open(outputFileName, "w")
         outputFile.write("\t".join(self.reportHeaderRow)+"\n")
         for line in self.report:
             outputFile.write("\t".join(line)+"\n")
         outputFile.close()
+        return outputFileName
 
 
     def define_sample_properties(self):
@@ -571,6 +794,38 @@ class ReportDB:
         return reportDBString
 
 
+class QCColumns:
+    """
+    Holds the columns mark_qc works on, one entry for every peak at a locus
+    of interest in a sample with a profile. mark_parent_peaks fills these
+    as it marks the peaks. Heights and sizes are kept as the report strings
+    and converted by the QC engines. Each sample and locus, and each sample
+    and dye, is numbered so the engines can group on plain integers.
+    parentIndex and pullupIndex are the positions of a parent peak in
+    Peak_BP and in its pullup list, or -1 for other peaks.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.heights = []
+        self.sizes = []
+        self.locusIds = []
+        self.dyeIds = []
+        self.parentIndex = []
+        self.pullupIndex = []
+        self.locusIndex = {}
+        self.dyeIndex = {}
+
+    def add(self, peak, sampleName, marker, dye, height, size, parentIndex, pullupIndex):
+        self.rows.append(peak)
+        self.heights.append(height)
+        self.sizes.append(size)
+        self.locusIds.append(self.locusIndex.setdefault((sampleName, marker), len(self.locusIndex)))
+        self.dyeIds.append(self.dyeIndex.setdefault((sampleName, dye), len(self.dyeIndex)))
+        self.parentIndex.append(parentIndex)
+        self.pullupIndex.append(pullupIndex)
+
+
 class LocusProperties:
     def __init__(self):
 
@@ -589,6 +844,7 @@ class LocusProperties:
 class SampleProperties:
     def __init__(self, sampleName):
         self.sampleName = sampleName
+        self.profile = None
 
         self.loci = {
             "AMEL": LocusProperties(), "D3S1358": LocusProperties(), "D1S1656": LocusProperties(),
@@ -634,14 +890,3 @@ class SamplePullup:
         red = "\, ".join(self.Red)+"\n"
         return "Pullup BP: "+"\n"+blue+green+yellow+red
 
-
-class TestAlleleUnit(unittest.TestCase):
-
-    def test_microvariant(self):
-        self.assertFalse(AlleleUnit(14.1, "TPOX") == AlleleUnit(14, "TPOX"))
-        self.assertFalse(AlleleUnit(11.3, "TPOX") == AlleleUnit(11.2, "TPOX"))
-        self.assertTrue(AlleleUnit(10, "TPOX") == AlleleUnit(10.0, "TPOX"))
-
-
-if __name__ == "__main__":
-    unittest.main()
@@ -1,50 +1,174 @@
 
 import os
 import sys
-import csv
 import time
-import copy
+import argparse
 
 import strlibrary
 
 
-# Start a timer to measure speed
-start = time.perf_counter()
+def parse_arguments(argv=None):
+    """Reads the command line. Inputs can be files, directories or glob
+    patterns; directories are expanded to the report files inside them."""
+    parser = argparse.ArgumentParser(
+        prog="stutter_caller",
+        description="Adds stutter calls to GeneMarker LIMS report exports.")
+    parser.add_argument("inputs", nargs="+",
+                        help="LIMS report files, directories or glob patterns")
+    parser.add_argument("-p", "--profiles", required=True,
+                        help="tsv file with the reference profiles")
+    parser.add_argument("-m", "--mixtures",
+                        help="tsv file listing the profiles in each mixture")
+    parser.add_argument("-o", "--output-dir",
+                        help="directory for the output files, "
+                             "defaults to the directory of each input")
+    parser.add_argument("--suffix", default="_newoutput",
+                        help="added to the input name to make the output name "
+                             "(default: %(default)s)")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python",
+                        help="engine for the QC stage, numpy is only loaded "
+                             "when selected (default: %(default)s)")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="number of files to analyze in parallel "
+                             "(default: %(default)s)")
+    parser.add_argument("--saturation", type=float, default=strlibrary.saturation_threshold,
+                        help="saturation threshold in RFU (default: %(default)s)")
+    parser.add_argument("--dropout", type=float, default=strlibrary.dropout_threshold,
+                        help="dropout threshold in RFU (default: %(default)s)")
+    parser.add_argument("--overlap", type=float, default=strlibrary.overlap_window,
+                        help="overlap window in bp (default: %(default)s)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not report the run time")
+    arguments = parser.parse_args(argv)
+    if arguments.workers < 1:
+        parser.error("--workers must be at least 1")
+    if arguments.dropout > arguments.saturation:
+        parser.error("--dropout must not be above --saturation")
+    if arguments.engine == "numpy":
+        import importlib.util
+        if importlib.util.find_spec("numpy") is None:
+            parser.error("--engine numpy needs numpy, install it or use --engine python")
+    return arguments
 
 
-def main():
+def expand_inputs(inputs, excluded=(), suffix="_newoutput"):
+    """Turns the input arguments into a sorted list of report files.
+    Existing paths are used as given, anything else is treated as a glob
+    pattern. Arguments that match nothing are reported on stderr. When a
+    directory is expanded, hidden files and sub directories are skipped as
+    before, and so are the excluded files (the profiles and mixtures) and
+    output files from an earlier run, which end in suffix + ".tsv"."""
+    excluded = {os.path.abspath(path) for path in excluded}
+    files = set()
+    for pattern in inputs:
+        if os.path.exists(pattern):
+            paths = [pattern]
+        else:
+            import glob
+            paths = glob.glob(pattern)
+        if not paths:
+            print(f"Warning: {pattern} did not match any files", file=sys.stderr)
+        for path in paths:
+            if os.path.isdir(path):
+                for file in os.listdir(path):
+                    filePath = os.path.join(path, file)
+                    if not file.startswith(".") and not os.path.isdir(filePath) \
+                            and not file.endswith(suffix + ".tsv") \
+                            and os.path.abspath(filePath) not in excluded:
+                        files.add(filePath)
+            else:
+                files.add(path)
+    return sorted(files)
+
+
+def find_output_clashes(files, output_dir, suffix):
+    """Returns the input files that would write to the same output file as
+    another input, worked out the same way write_output names its file."""
+    byOutput = {}
+    for file in files:
+        output = os.path.abspath(strlibrary.output_file_name(file, output_dir, suffix))
+        byOutput.setdefault(output, []).append(file)
+    return sorted(file for clash in byOutput.values() if len(clash) > 1 for file in clash)
+
+
+def load_profiles(arguments):
+    profile_db = strlibrary.ProfileDB(arguments.profiles)
+    if arguments.mixtures is not None:
+        profile_db.addMixes(arguments.mixtures)
+    return profile_db
+
+
+def analyze_file(file, profile_db, arguments):
+    """Runs every stage on a single report file and returns the name of
+    the output file."""
+    report_db = strlibrary.ReportDB(file)
+    report_db.mark_parent_peaks(profile_db)
+    report_db.mark_qc(arguments.saturation, arguments.dropout,
+                      arguments.overlap, arguments.engine)
+    report_db.mark_stutter(profile_db)
+    report_db.mark_pullup()
+    return report_db.write_output(arguments.output_dir, arguments.suffix)
+
+
+def try_analyze_file(file, profile_db, arguments):
+    """Runs analyze_file and returns an error message instead of raising,
+    so one bad file does not stop the rest of the batch."""
+    try:
+        analyze_file(file, profile_db, arguments)
+    except Exception as error:
+        return f"{file}: {error}"
+    return None
+
+
+def main(argv=None):
     """
-    The main loop first sets the input data to be used by the analyzeAll
-    function.
+    The main loop reads the command line, loads the profiles once and
+    passes every input file through analyze_file. multiprocessing is only
+    imported when more than one worker is asked for. Files that fail are
+    reported on stderr and make the exit status 1.
     """
-    os.chdir(os.path.dirname(sys.argv[0]))
+    # Start a timer to measure speed
+    start = time.perf_counter()
 
-    input_directory = "Helen_GM_AT"
-    profiles_file_name = 'profiles_3500.tsv'
+    arguments = parse_arguments(argv)
+    excluded = [arguments.profiles]
+    if arguments.mixtures is not None:
+        excluded.append(arguments.mixtures)
+    files = expand_inputs(arguments.inputs, excluded, arguments.suffix)
+    if not files:
+        print("No input files found", file=sys.stderr)
+        return 1
+    clashes = find_output_clashes(files, arguments.output_dir, arguments.suffix)
+    if clashes:
+        print("These inputs would overwrite each other's output: "
+              + ", ".join(clashes), file=sys.stderr)
+        return 1
 
-    files = os.listdir(input_directory)
+    profile_db = load_profiles(arguments)
 
-    for file in files:
-        if not file.startswith("."):
-            if os.path.isdir(input_directory + "/" + file):
-                continue
-            else:
-                profile_db = strlibrary.ProfileDB(profiles_file_name)
-                profile_db.addMixes("Mixtures.tsv")
+    if arguments.workers > 1 and len(files) > 1:
+        import functools
+        import multiprocessing
 
-                report_db = strlibrary.ReportDB(input_directory + "/" + file)
-                report_db.mark_parent_peaks(profile_db)
-                report_db.mark_stutter(profile_db)
-                report_db.mark_pullup()
-                report_db.write_output()
+        analyze = functools.partial(try_analyze_file, profile_db=profile_db,
+                                    arguments=arguments)
+        with multiprocessing.Pool(min(arguments.workers, len(files))) as pool:
+            errors = pool.map(analyze, files)
+    else:
+        errors = [try_analyze_file(file, profile_db, arguments) for file in files]
 
+    errors = [error for error in errors if error is not None]
+    for error in errors:
+        print(error, file=sys.stderr)
 
     # stop the timer to report the total time it took to complete
     # and report this time to the command line
     finish = time.perf_counter()
 
-    print(f'Finished in {round(finish - start, 2)} second(s)')
+    if not arguments.quiet:
+        print(f'Finished in {round(finish - start, 2)} second(s)')
+    return 1 if errors else 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import os
+import random
+import tempfile
+import unittest
+
+from strlibrary import AlleleUnit, ProfileDB, ReportDB, loci
+
+
+class TestAlleleUnit(unittest.TestCase):
+
+    def test_microvariant(self):
+        self.assertFalse(AlleleUnit(14.1, "TPOX") == AlleleUnit(14, "TPOX"))
+        self.assertFalse(AlleleUnit(11.3, "TPOX") == AlleleUnit(11.2, "TPOX"))
+        self.assertTrue(AlleleUnit(10, "TPOX") == AlleleUnit(10.0, "TPOX"))
+
+
+class TestReportQC(unittest.TestCase):
+
+    reportRows = [
+        ["D3S1358", "Blue", "120.0", "10", "500"],
+        ["D3S1358", "Blue", "124.0", "11", "150"],
+        ["D3S1358", "Blue", "128.0", "12", "35000"],
+        ["D1S1656", "Blue", "180.0", "10", "50"],
+        ["D1S1656", "Blue", "176.0", "9", "20"],
+        ["D1S1656", "Blue", "188.0", "12", "800"],
+        ["D2S441", "Blue", "220.0", "10", "600"],
+        ["D2S441", "Blue", "216.0", "9", "60"],
+        ["D16S539", "Green", "150.0", "10", "900"],
+        ["D16S539", "Green", "146.0", "9", "90"],
+        ["D16S539", "Green", "158.0", "12", "1000"],
+        ["D18S51", "Green", "158.3", "OL", "200"]]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.profilesFile = os.path.join(self.directory.name, "profiles.tsv")
+        self.reportFile = os.path.join(self.directory.name, "report.tsv")
+
+        with open(self.profilesFile, "w") as output:
+            output.write("Sample Name\t" + "\t".join(loci) + "\n")
+            output.write("S1\tX\t" + "\t".join(["10,12"] * (len(loci) - 1)) + "\n")
+
+        with open(self.reportFile, "w") as output:
+            output.write("\t".join(["Index", "Sample File", "Marker", "Dye", "Size",
+                                    "Allele", "Height", "Sample Comments"]) + "\n")
+            for x, row in enumerate(self.reportRows):
+                output.write("\t".join([str(x), "A01_S1_run.fsa"] + row + [""]) + "\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_qc(self, engine):
+        profiles = ProfileDB(self.profilesFile)
+        report = ReportDB(self.reportFile)
+        report.mark_parent_peaks(profiles)
+        report.mark_qc(engine=engine)
+        report.mark_stutter(profiles)
+        return report
+
+    def test_qc_flags(self):
+        report = self.run_qc("python")
+        calls = [line[report.Program_Output] for line in report.report]
+        self.assertEqual(calls, ["Par", "f", "Par,sat", "del1,db", "X", "Par",
+                                 "Par", "b", "Par,db", "b", "Par,overlap", "overlap"])
+
+        sampleLoci = report.samplePropertiesDict["A01_S1_run.fsa"].loci
+        self.assertTrue(sampleLoci["D3S1358"].Saturation)
+        self.assertFalse(sampleLoci["D3S1358"].Drop_Out)
+        self.assertTrue(sampleLoci["D1S1656"].Drop_Out)
+        self.assertTrue(sampleLoci["D2S441"].Drop_Out)
+        self.assertTrue(sampleLoci["FGA"].Drop_Out)
+        self.assertFalse(sampleLoci["D16S539"].Drop_Out)
+        self.assertFalse(sampleLoci["AMEL"].Drop_Out)
+
+    def test_flagged_parents_are_not_used(self):
+        report = self.run_qc("python")
+        sampleLoci = report.samplePropertiesDict["A01_S1_run.fsa"].loci
+        self.assertEqual(sampleLoci["D3S1358"].Peak_Profiles, ["10"])
+        self.assertEqual(sampleLoci["D1S1656"].Peak_Profiles, ["12"])
+        pullup = report.samplePullupDict["A01_S1_run.fsa"]
+        self.assertIn("128.0", pullup.Blue)
+        self.assertNotIn("180.0", pullup.Blue)
+
+    def test_failed_sample_is_not_drop_out(self):
+        with open(self.reportFile, "a") as output:
+            output.write("\t".join(["99", "A02_S1_run.fsa", "D3S1358", "Blue", "120.0",
+                                    "10", "500", "ILS Failure"]) + "\n")
+            output.write("\t".join(["100", "A02_S1_run.fsa", "D3S1358", "Blue", "128.0",
+                                     "12", "500", "ILS Failure"]) + "\n")
+        report = self.run_qc("python")
+        sampleLoci = report.samplePropertiesDict["A02_S1_run.fsa"].loci
+        self.assertFalse(any(locus.Drop_Out for locus in sampleLoci.values()))
+
+    # Sizes 100.0 and 100.2 are marker A at one locus and 100.4 is marker B.
+    overlapColumns = (["500", "500", "500"], ["100.0", "100.2", "100.4"],
+                      [0, -1, -1], [0, 0, 1], [0, 0, 0], [0, 1], 30000, 100, 0.5)
+
+    def import_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+
+    def test_overlap_past_same_marker_peak(self):
+        _, _, overlapping, _ = ReportDB(self.reportFile).qc_python(*self.overlapColumns)
+        self.assertEqual(overlapping, [0, 1, 2])
+
+    def test_overlap_past_same_marker_peak_numpy(self):
+        self.import_numpy()
+        _, _, overlapping, _ = ReportDB(self.reportFile).qc_numpy(*self.overlapColumns)
+        self.assertEqual(overlapping, [0, 1, 2])
+
+    def test_engines_agree_on_random_columns(self):
+        """Large dye group numbers and sizes right at the edge of the
+        overlap window must give the same answer in both engines."""
+        self.import_numpy()
+        report = ReportDB(self.reportFile)
+        generator = random.Random(26)
+        for _ in range(200):
+            count = generator.randint(0, 40)
+            sizes = ["%.2f" % generator.uniform(250, 260) for _ in range(count)]
+            sizes += ["%.2f" % (float(size) + 0.5) for size in sizes[:count // 4]]
+            count = len(sizes)
+            dyeIds = [400000 + generator.randint(0, 2) for _ in range(count)]
+            locusIds = [generator.randint(0, 5) for _ in range(count)]
+            heights = [str(generator.randint(0, 40000)) for _ in range(count)]
+            parentIndex = [generator.choice([-1, 0, 1]) for _ in range(count)]
+            locusMarkers = [generator.randint(0, 3) for _ in range(6)]
+            columns = (heights, sizes, parentIndex, locusIds, dyeIds, locusMarkers,
+                       30000, 100, 0.5)
+            self.assertEqual(report.qc_numpy(*columns), report.qc_python(*columns))
+
+        columns = (["500", "500"], ["255.66", "256.16"], [-1, -1], [0, 1],
+                   [400000, 400000], [0, 1], 30000, 100, 0.5)
+        self.assertEqual(report.qc_numpy(*columns), report.qc_python(*columns))
+        self.assertEqual(report.qc_python(*columns)[2], [0, 1])
+
+    def test_dropout_above_saturation(self):
+        report = ReportDB(self.reportFile)
+        report.mark_parent_peaks(ProfileDB(self.profilesFile))
+        with self.assertRaises(ValueError):
+            report.mark_qc(saturation=100, dropout=200)
+
+    def test_unknown_engine(self):
+        report = ReportDB(self.reportFile)
+        report.mark_parent_peaks(ProfileDB(self.profilesFile))
+        with self.assertRaises(ValueError):
+            report.mark_qc(engine="fortran")
+
+    def test_numpy_matches_python(self):
+        self.import_numpy()
+        self.assertEqual(str(self.run_qc("numpy")), str(self.run_qc("python")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+import subprocess
+import unittest.mock
+
+import stutter_caller
+from strlibrary import loci
+
+
+class TestStutterCaller(unittest.TestCase):
+
+    reportRows = [
+        ["D3S1358", "Blue", "120.0", "10", "500"],
+        ["D3S1358", "Blue", "116.0", "9", "60"],
+        ["D3S1358", "Blue", "128.0", "12", "35000"]]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.profilesFile = os.path.join(self.directory.name, "profiles.tsv")
+        self.reportDirectory = os.path.join(self.directory.name, "reports")
+        os.mkdir(self.reportDirectory)
+
+        with open(self.profilesFile, "w") as output:
+            output.write("Sample Name\t" + "\t".join(loci) + "\n")
+            output.write("S1\tX\t" + "\t".join(["10,12"] * (len(loci) - 1)) + "\n")
+
+        for name in ["plate1.txt", "plate2.txt"]:
+            with open(os.path.join(self.reportDirectory, name), "w") as output:
+                output.write("\t".join(["Index", "Sample File", "Marker", "Dye", "Size",
+                                        "Allele", "Height", "Sample Comments"]) + "\n")
+                for x, row in enumerate(self.reportRows):
+                    output.write("\t".join([str(x), "A01_S1_run.fsa"] + row + [""]) + "\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_calls(self, fileName):
+        with open(fileName) as data:
+            return [line.rstrip("\n").split("\t")[-1] for line in data][1:]
+
+    def test_glob_and_suffix(self):
+        pattern = os.path.join(self.reportDirectory, "plate1.*")
+        self.assertEqual(stutter_caller.main(
+            [pattern, "-p", self.profilesFile, "--suffix", "_calls", "-q"]), 0)
+        outputFile = os.path.join(self.reportDirectory, "plate1_calls.tsv")
+        self.assertEqual(self.read_calls(outputFile), ["Par", "b", "Par,sat"])
+        self.assertFalse(os.path.exists(os.path.join(self.reportDirectory, "plate2_calls.tsv")))
+
+    def test_directory_workers_and_output_dir(self):
+        outputDirectory = os.path.join(self.directory.name, "out")
+        os.mkdir(outputDirectory)
+        stutter_caller.main([self.reportDirectory, "-p", self.profilesFile,
+                             "-o", outputDirectory, "-j", "2", "--saturation", "40000", "-q"])
+        self.assertEqual(sorted(os.listdir(outputDirectory)),
+                         ["plate1_newoutput.tsv", "plate2_newoutput.tsv"])
+        self.assertEqual(self.read_calls(os.path.join(outputDirectory, "plate2_newoutput.tsv")),
+                         ["Par,db", "b", "Par"])
+
+    def test_no_inputs(self):
+        missing = os.path.join(self.directory.name, "missing*.txt")
+        self.assertEqual(stutter_caller.main([missing, "-p", self.profilesFile, "-q"]), 1)
+
+    def test_literal_path_and_missing_inputs(self):
+        bracketFile = os.path.join(self.reportDirectory, "plate[1].txt")
+        os.rename(os.path.join(self.reportDirectory, "plate1.txt"), bracketFile)
+        missing = os.path.join(self.directory.name, "missing.txt")
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            stutter_caller.main([bracketFile, missing, "-p", self.profilesFile, "-q"])
+        self.assertTrue(os.path.exists(os.path.join(self.reportDirectory, "plate[1]_newoutput.tsv")))
+        self.assertIn(missing, stderr.getvalue())
+
+    def test_output_name_clash(self):
+        otherDirectory = os.path.join(self.directory.name, "other")
+        os.mkdir(otherDirectory)
+        shutil.copy(os.path.join(self.reportDirectory, "plate1.txt"), otherDirectory)
+        outputDirectory = os.path.join(self.directory.name, "out")
+        os.mkdir(outputDirectory)
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            result = stutter_caller.main([self.reportDirectory, otherDirectory, "-p",
+                                          self.profilesFile, "-o", outputDirectory, "-q"])
+        self.assertEqual(result, 1)
+        self.assertEqual(os.listdir(outputDirectory), [])
+        self.assertIn("plate1.txt", stderr.getvalue())
+
+    def test_directory_skips_profiles_outputs_and_bad_files(self):
+        shutil.copy(self.profilesFile, self.reportDirectory)
+        profilesFile = os.path.join(self.reportDirectory, "profiles.tsv")
+        with open(os.path.join(self.reportDirectory, "plate1_newoutput.tsv"), "w") as output:
+            output.write("old output\n")
+        with open(os.path.join(self.reportDirectory, "broken.txt"), "w") as output:
+            output.write("not a report\n")
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            result = stutter_caller.main([self.reportDirectory, "-p", profilesFile, "-q"])
+        self.assertEqual(result, 1)
+        self.assertEqual(sorted(os.listdir(self.reportDirectory)),
+                         ["broken.txt", "plate1.txt", "plate1_newoutput.tsv", "plate2.txt",
+                          "plate2_newoutput.tsv", "profiles.tsv"])
+        self.assertEqual(self.read_calls(os.path.join(self.reportDirectory, "plate1_newoutput.tsv")),
+                         ["Par", "b", "Par,sat"])
+        self.assertIn(os.path.join(self.reportDirectory, "broken.txt") + ": ", stderr.getvalue())
+
+    def test_output_name_clash_in_one_directory(self):
+        shutil.copy(os.path.join(self.reportDirectory, "plate1.txt"),
+                    os.path.join(self.reportDirectory, "plate1.tsv"))
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            result = stutter_caller.main([self.reportDirectory, "-p", self.profilesFile, "-q"])
+        self.assertEqual(result, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.reportDirectory, "plate1_newoutput.tsv")))
+        self.assertIn("plate1.tsv", stderr.getvalue())
+
+    def test_missing_numpy_engine(self):
+        with unittest.mock.patch("importlib.util.find_spec", return_value=None), \
+                contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit) as error:
+                stutter_caller.parse_arguments(["x", "-p", "y", "--engine", "numpy"])
+        self.assertEqual(error.exception.code, 2)
+
+    def run_time(self, command):
+        """Shortest wall clock time of several runs, to keep the budget
+        check steady on a busy machine."""
+        times = []
+        for _ in range(self.timingRuns):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, capture_output=True)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    # A quick single file invocation may take at most this much longer than
+    # starting a bare interpreter.
+    invocationBudget = 0.05
+    timingRuns = 5
+
+    def test_single_file_invocation_budget(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stutter_caller.py")
+        reportFile = os.path.join(self.reportDirectory, "plate1.txt")
+        baseline = self.run_time([sys.executable, "-c", "pass"])
+        invocation = self.run_time([sys.executable, script, reportFile,
+                                    "-p", self.profilesFile, "-q"])
+        self.assertLess(invocation - baseline, self.invocationBudget)
+
+    def test_startup_is_lazy(self):
+        """Importing the entry point must stay cheap. Optional engines and
+        the test framework are only loaded when they are used."""
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c",
+             "import sys, stutter_caller; "
+             "print(','.join(sorted({'numpy', 'multiprocessing', 'unittest', 'glob'} & set(sys.modules))))"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "")
+
+        importTimes = [line.split("|") for line in result.stderr.splitlines()
+                       if line.startswith("import time:")]
+        cumulative = [int(fields[1]) for fields in importTimes
+                      if fields[2].strip() == "stutter_caller"]
+        self.assertEqual(len(cumulative), 1)
+        self.assertLess(cumulative[0], 50000)
+
+
+if __name__ == "__main__":
+    unittest.main()